@@ -1,13 +1,46 @@
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import html as lxml_html
 import time
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 import os
+import re
+import sys
+import json
+import random
+import hashlib
+import subprocess
+
+# Text shown when every appointment is booked
+NO_APPT = "Derzeit sind alle verfügbaren Termine ausgebucht"
+# Location details expected on the location page
+LOC_MARKER = "Ausländerbehörde Dresden 33.41"
+THEATER = "Theaterstraße"
+
+# div.content and div.row of the results page, matched by class token
+CONTENT_XPATH = "//div[contains(concat(' ', normalize-space(@class), ' '), ' content ')]"
+ROW_XPATH = ".//div[contains(concat(' ', normalize-space(@class), ' '), ' row ')]"
+
+# Charset parameter of a Content-Type header
+CHARSET_RE = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'de-DE,de;q=0.9,en;q=0.8',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1'
+}
 
 class DresdnAppointmentChecker:
+    # The pages we expect are small, anything bigger is not one of them
+    MAX_BODY_BYTES = 256 * 1024
+    # Local time zone of the Bürgerbüro, used for scheduling checks
+    TIMEZONE = 'Europe/Berlin'
+
     def __init__(self, email_config):
         """
         Initialize the appointment checker
@@ -20,134 +53,222 @@ class DresdnAppointmentChecker:
             'sender_password': 'your_app_password',
             'recipient_email': 'recipient@gmail.com'
         }
+        
+        Optional scheduling keys (hours in Dresden local time):
+            'hot_windows': [(7, 9)]   # check often while new slots are usually released
+            'quiet_hours': (22, 6)    # don't check at all, None to always check
         """
-        self.base_url = "https://termine-buergerbuero.dresden.de"
+        self.host = "termine-buergerbuero.dresden.de"
+        self.base_url = f"https://{self.host}"
         self.start_url = f"{self.base_url}/select2?md=1"
         self.final_url = f"{self.base_url}/location?mdt=9&select_cnc=1&cnc-442=1"
         self.email_config = email_config
         self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'de-DE,de;q=0.9,en;q=0.8',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1'
-        })
+        # Keep the connection alive so the requests of one check share a single TLS handshake
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=4,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[429, 502, 503, 504],
+                # The form POST only navigates, so it is as safe to repeat as the GETs
+                allowed_methods=frozenset(['HEAD', 'GET', 'POST'])
+            )
+        ))
+        self.session.headers.update(HEADERS)
         self.last_state = None
+        # Hash of the last final page that said no appointments were available
+        self.last_page_hash = None
+        # Validators and form data of the last location page, for conditional requests
+        self.etag = None
+        self.last_modified = None
+        self.form_data = None
         
-    def check_appointments(self):
+    def check_appointments(self, raise_network_errors=False):
         """
         Navigate through the booking system to check for available appointments
+        raise_network_errors: re-raise network errors instead of reporting them as a result
         Returns: (bool, str) - (appointments_available, message)
         """
         try:
             # Step 1: Get the initial page
             print("  Step 1: Loading initial page...")
-            response = self.session.get(self.start_url, timeout=30)
-            response.raise_for_status()
+            # Start every check with a fresh server session
+            self.session.cookies.clear()
+            self.fetch('GET', self.start_url)
 
-            set_cookie = response.headers.get("Set-Cookie")
-            if not set_cookie:
+            # The session keeps the cookies from Set-Cookie for the next requests
+            if not self.session.cookies:
                 return False, "⚠️ Session error - set-cookie was not found"
 
             print("  Step 2: Jumping to location page...")
-            headers = {
-                "Cookie": set_cookie
-            }
-            response = self.session.get(self.final_url, headers=headers, timeout=30)
-            response.raise_for_status()
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Check if we got an error page
-            if 'fehlermeldung' in response.text.lower():
-                return False, "⚠️ Cookie issue"
-            
-            # Verify we see the Ausländerbehörde location
-            page_text = response.text
-            if 'Ausländerbehörde Dresden 33.41' not in page_text or 'Theaterstraße' not in page_text:
-                return False, "⚠️ Could not find expected location information"
+            # Ask the server to skip the body if the location page has not changed
+            headers = {}
+            if self.form_data is not None:
+                if self.etag:
+                    headers['If-None-Match'] = self.etag
+                if self.last_modified:
+                    headers['If-Modified-Since'] = self.last_modified
+            response, body = self.fetch('GET', self.final_url, headers=headers)
             
             # Step 5: Click "Weiter" button to proceed to appointment page
             print("  Step 3: Proceeding to appointment selection...")
-            weiter_button = soup.find('input', {'type': 'submit', 'value': 'Weiter', 'id': 'WeiterButton'})
-            
-            if not weiter_button:
-                # Try without ID
-                weiter_button = soup.find('input', {'type': 'submit', 'value': 'Weiter'})
-            
-            if not weiter_button:
-                return False, "⚠️ Could not find 'Weiter' button on location page"
-            
-            form = weiter_button.find_parent('form')
-            if not form:
-                return False, "⚠️ Could not find form for Weiter button"
-            
-            form_data = {}
-            for input_field in form.find_all('input'):
-                name = input_field.get('name')
-                value = input_field.get('value', '')
-                if name:
-                    form_data[name] = value
-
-            set_cookie = f"{set_cookie}; {'tvo_cookie_accept=0'}"
-            headers = {
-                "Cookie": set_cookie
-            }
-            response = self.session.post(self.final_url, data=form_data, headers=headers, timeout=30)
-            response.raise_for_status()
+            if response.status_code == 304:
+                # Same page as last time, so the same form data
+                form_data = self.form_data
+            else:
+                form_data, error = self.parse_location_page(body, self.declared_charset(response))
+                if error:
+                    return False, error
+                self.form_data = form_data
+                self.etag = response.headers.get('ETag')
+                self.last_modified = response.headers.get('Last-Modified')
+
+            self.session.cookies.set('tvo_cookie_accept', '0', domain=self.host)
+            response, final_page = self.fetch('POST', self.final_url, data=form_data)
+
+            # A byte-identical copy of the last "no appointments" page needs no further checks
+            page_hash = hashlib.blake2b(final_page, digest_size=16).digest()
+            if page_hash == self.last_page_hash and self.last_state is False:
+                return False, "❌ No appointments available (unchanged)"
 
-            soup = BeautifulSoup(response.text, 'html.parser')
-            main_element = soup.find("div", class_="content")
-            final_element = main_element.find("div", class_="row") if main_element else None
+            tree = self.parse_page(final_page, self.declared_charset(response))
+            content_divs = tree.xpath(CONTENT_XPATH)
+            main_element = content_divs[0] if content_divs else None
+            row_divs = main_element.xpath(ROW_XPATH) if main_element is not None else []
+            final_element = row_divs[0] if row_divs else None
 
-            # Check if we got an error page
-            if not final_element or 'Fehlermeldung' in main_element.get_text():
+            # Check if we got an error page (or any other page without the results box)
+            if final_element is None or 'Fehlermeldung' in main_element.text_content():
                 return False, "⚠️ Something went wrong"
             
             # Step 6: Check the final page for appointments
             print("  Step 4: Checking appointment availability...")
             # Check for the "no appointments" message
-            no_appointments_text = "Derzeit sind alle verfügbaren Termine ausgebucht"
-            
-            if final_element and no_appointments_text in final_element.get_text():
+            if NO_APPT in final_element.text_content():
+                self.last_page_hash = page_hash
                 return False, "❌ No appointments available"
             else:
                 # The apology text is not present, appointments might be available!
                 return True, f"✅ APPOINTMENTS AVAILABLE! Check immediately: {self.base_url}/suggest"
                 
         except requests.exceptions.RequestException as e:
+            if raise_network_errors:
+                raise
             return False, f"⚠️ Network error: {str(e)}"
         except Exception as e:
             return False, f"⚠️ Error during navigation: {str(e)}"
     
+    def fetch(self, method, url, **kwargs):
+        """
+        Send a request and read at most MAX_BODY_BYTES of the decoded body
+        Returns: (Response, bytes) - (response, body)
+        """
+        with self.session.request(method, url, stream=True, timeout=30, **kwargs) as response:
+            response.raise_for_status()
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                size += len(chunk)
+                if size > self.MAX_BODY_BYTES:
+                    raise ValueError(f"Response from {url} is larger than {self.MAX_BODY_BYTES // 1024} KB")
+                chunks.append(chunk)
+        return response, b''.join(chunks)
+    
+    def declared_charset(self, response):
+        """
+        Charset declared in the Content-Type header, None if there is none
+        (requests would fall back to ISO-8859-1 for text/html instead)
+        """
+        match = CHARSET_RE.search(response.headers.get('Content-Type', ''))
+        return match.group(1) if match else None
+    
+    def parse_page(self, body, encoding=None):
+        """
+        Parse raw page bytes with lxml
+        encoding: charset declared by the server, without one lxml reads the page's <meta charset>
+        """
+        parser = lxml_html.HTMLParser(encoding=encoding) if encoding else None
+        return lxml_html.fromstring(body, parser=parser)
+    
+    def parse_location_page(self, body, encoding=None):
+        """
+        Extract the data of the form behind the "Weiter" button
+        body: raw page bytes, only decoded by the parser
+        encoding: charset declared in the Content-Type header, if any
+        Returns: (dict, str) - (form_data, error_message)
+        """
+        # Decode once, the markers are checked on the same text the form is read from
+        tree = self.parse_page(body, encoding)
+        page_text = tree.text_content()
+        
+        # Check if we got an error page
+        if 'fehlermeldung' in page_text.lower():
+            return None, "⚠️ Cookie issue"
+        
+        # Verify we see the Ausländerbehörde location
+        if LOC_MARKER not in page_text or THEATER not in page_text:
+            return None, "⚠️ Could not find expected location information"
+        
+        # Go straight to the form holding the "Weiter" submit button
+        forms = tree.xpath("//input[@type='submit' and @value='Weiter']/ancestor::form[1]")
+        if not forms:
+            return None, "⚠️ Could not find form for Weiter button"
+        form = forms[0]
+        
+        form_data = {
+            input_field.get('name'): input_field.get('value', '')
+            for input_field in form.iter('input')
+            if input_field.get('name')
+        }
+        
+        return form_data, None
+    
     def send_email(self, subject, body):
-        """Send email notification"""
+        """
+        Send email notification from a separate process, so a stuck or failing
+        SMTP server can never block or crash the checker
+        """
+        payload = json.dumps({
+            'email_config': self.email_config,
+            'subject': subject,
+            'body': body
+        })
         try:
-            msg = MIMEMultipart()
-            msg['From'] = self.email_config['sender_email']
-            msg['To'] = self.email_config['recipient_email']
-            msg['Subject'] = subject
-            
-            msg.attach(MIMEText(body, 'plain'))
-            
-            with smtplib.SMTP(self.email_config['smtp_server'], self.email_config['smtp_port'], timeout=30) as server:
-                server.starttls()
-                server.login(self.email_config['sender_email'], self.email_config['sender_password'])
-                server.send_message(msg)
-                
-            print(f"✉️ Email sent: {subject}")
-            return True
-        except Exception as e:
-            print(f"❌ Failed to send email: {str(e)}")
+            proc = subprocess.Popen(
+                [sys.executable, '-m', 'notifier'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL
+            )
+        except OSError as e:
+            print(f"❌ Failed to start notifier: {str(e)}")
             return False
+        
+        try:
+            proc.communicate(payload.encode('utf-8'), timeout=45)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            print("❌ Failed to send email: notifier timed out")
+            return False
+        
+        if proc.returncode != 0:
+            print(f"❌ Failed to send email: notifier exited with {proc.returncode}")
+            return False
+        
+        print(f"✉️ Email sent: {subject}")
+        return True
     
-    def run_once(self):
-        """Run a single check"""
+    def run_once(self, raise_network_errors=False):
+        """
+        Run a single check
+        raise_network_errors: let network errors propagate to the caller
+        """
         print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Checking for appointments...")
         
-        available, message = self.check_appointments()
+        available, message = self.check_appointments(raise_network_errors)
         print(message)
         
         # Send email if appointments are available and state changed
@@ -161,26 +282,86 @@ class DresdnAppointmentChecker:
         self.last_state = available
         return available
     
-    def run_continuously(self, check_interval=300):
+    def local_now(self):
+        """Current time in the Bürgerbüro's time zone"""
+        # Looked up lazily, so a missing tz database only affects scheduling
+        return datetime.now(ZoneInfo(self.TIMEZONE))
+    
+    def add_seconds(self, moment, seconds):
+        """Add elapsed seconds to an aware datetime (in UTC, so DST changes are respected)"""
+        return (moment.astimezone(timezone.utc) + timedelta(seconds=seconds)).astimezone(moment.tzinfo)
+    
+    def in_quiet_hours(self, now):
+        """Check whether now falls into the configured quiet hours"""
+        quiet_hours = self.email_config.get('quiet_hours', (22, 6))
+        if quiet_hours is None:
+            return False
+        start, end = quiet_hours
+        if start <= end:
+            return start <= now.hour < end
+        # The quiet hours span midnight
+        return now.hour >= start or now.hour < end
+    
+    def compute_next_slot(self, now, check_interval=600, hot_interval=30):
+        """
+        Work out when the next check should run
+        now: timezone-aware datetime in Dresden local time
+        Returns: datetime of the next check
+        """
+        if self.in_quiet_hours(now):
+            # Sleep through the night and check again once the quiet hours end
+            _, end = self.email_config.get('quiet_hours', (22, 6))
+            wake_up = now.replace(hour=end, minute=0, second=0, microsecond=0)
+            if wake_up <= now:
+                wake_up += timedelta(days=1)
+            return wake_up
+        
+        hot_windows = self.email_config.get('hot_windows', [(7, 9)])
+        if any(start <= now.hour < end for start, end in hot_windows):
+            return self.add_seconds(now, hot_interval)
+        
+        # Don't oversleep the start of the next hot window
+        next_poll = self.add_seconds(now, check_interval)
+        for start, _ in hot_windows:
+            window_start = now.replace(hour=start, minute=0, second=0, microsecond=0)
+            if now < window_start < next_poll:
+                next_poll = window_start
+        return next_poll
+    
+    def run_continuously(self, check_interval=600, hot_interval=30):
         """
         Run the checker continuously
-        check_interval: seconds between checks (default 300 = 5 minutes)
+        check_interval: seconds between checks (default 600 = 10 minutes)
+        hot_interval: seconds between checks inside the hot windows (default 30)
         """
         print(f"🤖 Starting Dresden Appointment Checker")
-        print(f"⏰ Checking every {check_interval} seconds")
+        print(f"⏰ Checking every {check_interval} seconds, every {hot_interval} seconds in hot windows")
         print(f"📧 Will notify: {self.email_config['recipient_email']}")
         print("-" * 50)
         
+        attempt = 0
         while True:
             try:
-                self.run_once()
-                time.sleep(check_interval)
+                if self.in_quiet_hours(self.local_now()):
+                    print("😴 Quiet hours, skipping check")
+                else:
+                    self.run_once(raise_network_errors=True)
+                    attempt = 0
+                next_poll = self.compute_next_slot(self.local_now(), check_interval, hot_interval)
+                # Timestamps give elapsed time, also across daylight saving changes
+                time.sleep(max(0, next_poll.timestamp() - time.time()))
             except KeyboardInterrupt:
                 print("\n👋 Stopping checker...")
                 break
             except Exception as e:
-                print(f"⚠️ Unexpected error: {str(e)}")
-                time.sleep(60)  # Wait a minute before retrying
+                # Back off exponentially (capped at 5 minutes) with jitter before retrying
+                delay = min(300, 5 * 2 ** attempt) + random.uniform(0, 5)
+                attempt += 1
+                if isinstance(e, requests.exceptions.RequestException):
+                    print(f"⚠️ Network error: {str(e)} - retrying in {delay:.0f} seconds")
+                else:
+                    print(f"⚠️ Unexpected error: {str(e)} - retrying in {delay:.0f} seconds")
+                time.sleep(delay)
 
 
 if __name__ == "__main__":
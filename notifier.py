@@ -0,0 +1,40 @@
+import json
+import smtplib
+import sys
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+
+def send_email(email_config, subject, body):
+    """Send email notification"""
+    msg = MIMEMultipart()
+    msg['From'] = email_config['sender_email']
+    msg['To'] = email_config['recipient_email']
+    msg['Subject'] = subject
+
+    msg.attach(MIMEText(body, 'plain'))
+
+    with smtplib.SMTP(email_config['smtp_server'], email_config['smtp_port'], timeout=30) as server:
+        server.starttls()
+        server.login(email_config['sender_email'], email_config['sender_password'])
+        server.send_message(msg)
+
+
+def main():
+    """
+    Entry point for `python -m notifier`
+
+    Reads {"email_config": {...}, "subject": "...", "body": "..."} as JSON from stdin.
+    The exit code is the only result: 0 when the email was sent, 1 otherwise.
+    """
+    try:
+        payload = json.load(sys.stdin)
+        send_email(payload['email_config'], payload['subject'], payload['body'])
+    except Exception as e:
+        print(f"❌ Failed to send email: {str(e)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())